@@ -10,7 +10,9 @@ import os
 from pathlib import Path
 import tempfile
 import json
-from unittest.mock import Mock, patch, MagicMock
+import asyncio
+import threading
+from unittest.mock import Mock, patch, MagicMock, AsyncMock
 
 # Add bot module to path
 sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -26,7 +28,14 @@ from bot import (
     validate_gitlab_token,
     get_gitlab_project_path,
     get_vcs_specific_config,
-    migrate_user_repos_format
+    migrate_user_repos_format,
+    get_lfs_locks,
+    get_lfs_lock_info,
+    invalidate_lfs_lock_cache,
+    run_git,
+    GitError,
+    parse_porcelain_v2_status,
+    format_locks_page
 )
 
 class TestRepositoryTypeDetection(unittest.TestCase):
@@ -102,7 +111,8 @@ class TestRepositoryURLValidator(unittest.TestCase):
             "https://github.com/user",  # Missing repository
             "https://github.com",       # Missing user/repo
             "https://github.com/user/repo/extra",  # Too many path parts
-            "ftp://github.com/user/repo"  # Wrong protocol
+            "ftp://github.com/user/repo",  # Wrong protocol
+            "https://[x/y"  # Unparseable host
         ]
         
         for url in invalid_urls:
@@ -139,6 +149,16 @@ class TestRepositoryURLValidator(unittest.TestCase):
                 normalized = self.validator.normalize_url(input_url, repo_type)
                 self.assertEqual(normalized, expected)
 
+    def test_cached_result_is_not_shared(self):
+        """Test that modifying a returned result does not affect later validations"""
+        url = "https://github.com/user"
+        first = self.validator.validate_url(url, REPO_TYPES['GITHUB'])
+        first['errors'].append("extra")
+        first['valid'] = True
+        second = self.validator.validate_url(url, REPO_TYPES['GITHUB'])
+        self.assertFalse(second['valid'])
+        self.assertNotIn("extra", second['errors'])
+
 class TestGitLabTokenValidation(unittest.TestCase):
     """Test GitLab token validation"""
     
@@ -203,7 +223,9 @@ class TestGitLabProjectPathExtraction(unittest.TestCase):
         invalid_urls = [
             "invalid-url",
             "",
-            None
+            None,
+            "https://[x/y",
+            42
         ]
         
         for url in invalid_urls:
@@ -254,6 +276,99 @@ class TestGitLabAPIClient(unittest.TestCase):
         
         self.assertEqual(result, {})  # Should return empty dict on failure
 
+    def test_fetch_files(self):
+        """Test fetching several files concurrently"""
+        def get(url, **kwargs):
+            response = MagicMock()
+            response.__enter__.return_value = response
+            response.iter_content.return_value = [url.rsplit('/', 2)[-2].encode()]
+            return response
+        mock_session = Mock(get=Mock(side_effect=get))
+        self.client.session = mock_session
+
+        result = asyncio.run(self.client.fetch_files("123", ["a.md", "docs/b.md"]))
+
+        self.assertEqual(result, {"a.md": "a.md", "docs/b.md": "docs%2Fb.md"})
+        self.assertEqual(mock_session.get.call_count, 2)
+
+    def test_shared_session_stores_no_cookies(self):
+        """Test that the session shared by all users never keeps cookies"""
+        import bot
+        policy = bot._http_session().cookies._policy
+        self.assertEqual(policy.allowed_domains(), ())
+
+    def test_github_credentials_not_in_url(self):
+        """Test that the GitHub accessibility check sends credentials with auth="""
+        import bot
+        session = Mock(head=Mock(return_value=Mock(status_code=200)))
+        with patch('bot._http_session', return_value=session):
+            result = bot.validate_repository_accessibility(
+                "https://github.com/user/repo.git", {'username': 'user', 'token': 'secret'})
+        self.assertTrue(result['accessible'])
+        url = session.head.call_args.args[0]
+        self.assertNotIn("secret", url)
+        self.assertEqual(session.head.call_args.kwargs['auth'], ('user', 'secret'))
+
+    def test_get_file_content_stream(self):
+        """Test that a file is written to disk chunk by chunk"""
+        response = MagicMock()
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [b"first ", b"second"]
+        self.client.session = Mock(get=Mock(return_value=response))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dest = Path(temp_dir) / "big.bin"
+            self.assertTrue(self.client.get_file_content_stream("123", "big.bin", "main", dest))
+            self.assertEqual(dest.read_bytes(), b"first second")
+            self.assertEqual(os.listdir(temp_dir), ["big.bin"])
+        self.assertTrue(self.client.session.get.call_args.kwargs['stream'])
+
+    def test_create_commit_batch(self):
+        """Test that actions are split into sequential commits of batch_size"""
+        posted = []
+        def post(url, data=None, **kwargs):
+            posted.append(json.loads(data))
+            return Mock(raise_for_status=Mock(return_value=None),
+                        json=Mock(return_value={"id": str(len(posted))}))
+        self.client.session = Mock(post=Mock(side_effect=post))
+        actions = ({"action": "create", "file_path": f"f{i}.md", "content": "x"} for i in range(5))
+
+        commits = self.client.create_commit_batch("123", "main", "Upload", actions, batch_size=2)
+
+        self.assertEqual([c["id"] for c in commits], ["1", "2", "3"])
+        self.assertEqual([len(p["actions"]) for p in posted], [2, 2, 1])
+        self.assertEqual(posted[1]["commit_message"], "Upload (part 2)")
+
+    def test_get_project_files_all_pages(self):
+        """Test that every page of a tree listing is returned in order"""
+        def get(url, params=None, **kwargs):
+            page = params.get('page', 1)
+            return Mock(raise_for_status=Mock(return_value=None),
+                        json=Mock(return_value=[{"name": f"p{page}"}]),
+                        headers={'X-Total-Pages': '3'})
+
+        self.client.session = Mock(get=Mock(side_effect=get))
+
+        result = self.client.get_project_files("123", "docs")
+
+        self.assertEqual([item["name"] for item in result], ["p1", "p2", "p3"])
+
+    def test_get_project_bundle(self):
+        """Test that project info and files come from one GraphQL request"""
+        mock_response = Mock()
+        mock_response.raise_for_status.return_value = None
+        mock_response.json.return_value = {"data": {"project": {
+            "name": "docs", "description": None,
+            "repository": {"blobs": {"nodes": [{"path": "a.md", "rawTextBlob": "A"}]}}}}}
+        self.client.session = Mock(post=Mock(return_value=mock_response))
+
+        result = self.client.get_project_bundle("group/docs", ["a.md", "missing.md"])
+
+        self.assertEqual(result["name"], "docs")
+        self.assertEqual(result["files"], {"a.md": "A", "missing.md": ""})
+        self.client.session.post.assert_called_once()
+        self.assertEqual(self.client.session.post.call_args[0][0], "https://gitlab.com/api/graphql")
+
 class TestVCSConfigurationManager(unittest.TestCase):
     """Test VCS configuration manager"""
     
@@ -325,6 +440,23 @@ class TestVCSConfigurationManager(unittest.TestCase):
             # Restore original function
             bot.load_user_repos = original_load
 
+    def test_credentials_configured_uses_registry(self):
+        """Test that credential checks look up the in-memory registry"""
+        import bot
+        with patch.object(bot, '_CRED_REGISTRY', {".git-credentials-lfs-456"}):
+            self.assertTrue(self.manager._check_credentials_configured(456, 'gitlab'))
+            self.assertFalse(self.manager._check_credentials_configured(456, 'github'))
+            self.assertFalse(self.manager._check_credentials_configured(45, 'gitlab'))
+
+    def test_missing_data_dir_is_an_empty_registry(self):
+        """Test that startup without the data directory is not reported as a failure"""
+        import bot
+        with patch('bot.os.scandir', side_effect=FileNotFoundError), \
+                patch.object(bot, '_CRED_REGISTRY', set()), patch('bot.logging.error') as mock_error:
+            bot.initialize_persistent_credentials()
+            self.assertEqual(bot._CRED_REGISTRY, set())
+        mock_error.assert_not_called()
+
 class TestMigration(unittest.TestCase):
     """Test migration functionality"""
     
@@ -369,6 +501,702 @@ class TestMigration(unittest.TestCase):
         self.assertIn('last_updated', user_entry)
         self.assertIn('created_at', user_entry)
 
+class TestLFSLockCache(unittest.TestCase):
+    """Test cached parsing of git lfs locks output"""
+
+    LOCKS_OUTPUT = json.dumps([
+        {"id": "6", "path": "docs/report.docx", "owner": {"name": "alice"}, "locked_at": "2024-01-02T10:00:00Z"},
+        {"id": "7", "path": "docs/sub/plan.docx", "owner": {"name": "bob"}, "locked_at": "2024-01-03T10:00:00Z"}
+    ])
+
+    def setUp(self):
+        self.repo_root = Path(tempfile.mkdtemp())
+        invalidate_lfs_lock_cache(self.repo_root)
+
+    def tearDown(self):
+        invalidate_lfs_lock_cache(self.repo_root)
+        os.rmdir(self.repo_root)
+
+    def _proc(self):
+        return Mock(returncode=0, stdout=self.LOCKS_OUTPUT, stderr='')
+
+    @patch('bot.subprocess.run')
+    def test_locks_are_parsed_and_cached(self, mock_run):
+        """Test that repeated lookups reuse a single git lfs locks call"""
+        mock_run.return_value = self._proc()
+
+        locks = get_lfs_locks(self.repo_root)
+        self.assertEqual(locks['docs/report.docx']['owner'], 'alice')
+        self.assertEqual(locks['docs/sub/plan.docx']['id'], '7')
+
+        info = get_lfs_lock_info('plan.docx', cwd=self.repo_root)
+        self.assertEqual(info['path'], 'docs/sub/plan.docx')
+        self.assertEqual(mock_run.call_count, 1)
+
+    @patch('bot.subprocess.run')
+    def test_invalidation_forces_refresh(self, mock_run):
+        """Test that invalidating the cache triggers a new listing"""
+        mock_run.return_value = self._proc()
+
+        get_lfs_locks(self.repo_root)
+        invalidate_lfs_lock_cache(self.repo_root)
+        get_lfs_locks(self.repo_root)
+        get_lfs_locks(self.repo_root, use_cache=False)
+        self.assertEqual(mock_run.call_count, 3)
+
+    @patch('bot.subprocess.run')
+    def test_failed_listing_raises_when_checked(self, mock_run):
+        """Test that check=True surfaces a failed listing as GitError"""
+        mock_run.return_value = Mock(returncode=2, stdout='', stderr='endpoint deprecated')
+
+        self.assertEqual(get_lfs_locks(self.repo_root), {})
+        with self.assertRaises(GitError):
+            get_lfs_locks(self.repo_root, check=True)
+
+    @patch('bot.subprocess.run')
+    def test_peek_only_returns_fresh_listing(self, mock_run):
+        """Test that peek_lfs_locks never runs git and sees cached listings"""
+        import bot
+        mock_run.return_value = self._proc()
+
+        self.assertIsNone(bot.peek_lfs_locks(self.repo_root))
+        get_lfs_locks(self.repo_root)
+        self.assertIn('docs/report.docx', bot.peek_lfs_locks(self.repo_root))
+        self.assertEqual(mock_run.call_count, 1)
+
+class TestLocksPaging(unittest.TestCase):
+    """Test paging of the admin lock listing"""
+
+    def test_pages_newest_first(self):
+        """Test that locks are sorted by lock time and split into pages"""
+        import bot
+        locks = [
+            {"path": f"docs/{i:02d}.docx", "owner": "alice", "id": str(i), "locked_at": f"2024-01-{i:02d}T00:00:00Z"}
+            for i in range(1, bot.LOCKS_PAGE_SIZE + 6)
+        ]
+
+        text, next_offset = format_locks_page(locks)
+        self.assertTrue(text.startswith(f"📄 docs/{bot.LOCKS_PAGE_SIZE + 5:02d}.docx"))
+        self.assertEqual(text.count("📄"), bot.LOCKS_PAGE_SIZE)
+        self.assertEqual(next_offset, bot.LOCKS_PAGE_SIZE)
+
+        text, next_offset = format_locks_page(locks, next_offset)
+        self.assertEqual(text.count("📄"), 5)
+        self.assertIsNone(next_offset)
+
+    def test_next_page_comes_from_the_cached_listing(self):
+        """Test that paging slices the listing built for the first page without re-querying locks"""
+        import bot
+        locks = [{"path": f"docs/{i:02d}.docx", "owner": "bob", "id": str(i), "locked_at": ""}
+                 for i in range(bot.LOCKS_PAGE_SIZE + 3)]
+        message = Mock(from_user=Mock(id=1), answer=AsyncMock())
+
+        with patch.object(bot, 'ADMIN_IDS', frozenset({"1"})), \
+                patch('bot.check_lock_status', new_callable=AsyncMock) as mock_check:
+            asyncio.run(bot.answer_locks_page(message, locks))
+            self.assertEqual(bot.locks_listings[1], (locks, bot.LOCKS_PAGE_SIZE))
+            asyncio.run(bot.show_more_locks(message))
+        mock_check.assert_not_awaited()
+        self.assertEqual(message.answer.await_args.args[0].count("📄"), 3)
+        self.assertNotIn(1, bot.locks_listings)
+
+class TestRunGit(unittest.TestCase):
+    """Test the async git subprocess helper"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(self.temp_dir)
+
+    def test_successful_command_returns_decoded_output(self):
+        """Test that stdout is returned as text"""
+        result = asyncio.run(run_git(["git", "--version"], cwd=self.temp_dir))
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("git version", result.stdout)
+
+    def test_failing_command_raises_git_error(self):
+        """Test that a non-zero exit raises GitError unless check is disabled"""
+        args = ["git", "rev-parse", "--git-dir"]
+        with self.assertRaises(GitError) as ctx:
+            asyncio.run(run_git(args, cwd=self.temp_dir))
+        self.assertNotEqual(ctx.exception.returncode, 0)
+        self.assertTrue(ctx.exception.stderr)
+
+        result = asyncio.run(run_git(args, cwd=self.temp_dir, check=False))
+        self.assertNotEqual(result.returncode, 0)
+
+    def test_env_overlays_are_built_once(self):
+        """Test that git_env reuses the merged environment for an overlay"""
+        import bot
+        self.assertIs(bot.git_env(), bot._BASE_GIT_ENV)
+        env = bot.git_env({'GIT_LFS_SKIP_SMUDGE': '1'})
+        self.assertEqual(env['GIT_LFS_SKIP_SMUDGE'], '1')
+        self.assertEqual(env['GIT_TERMINAL_PROMPT'], '0')
+        self.assertIs(bot.git_env({'GIT_LFS_SKIP_SMUDGE': '1'}), env)
+
+    def test_max_output_keeps_only_the_head(self):
+        """Test that bounded calls truncate stdout and discard it when zero"""
+        result = asyncio.run(run_git(["git", "--version"], cwd=self.temp_dir, max_output=3))
+        self.assertEqual(result.stdout, "git")
+        result = asyncio.run(run_git(["git", "--version"], cwd=self.temp_dir, max_output=0))
+        self.assertEqual(result.stdout, "")
+
+    def test_bounded_call_keeps_stderr_tail(self):
+        """Test that the end of stderr (the error) survives bounded collection"""
+        with patch('bot.GIT_STDERR_LIMIT', 16):
+            with self.assertRaises(GitError) as ctx:
+                asyncio.run(run_git(["git", "rev-parse", "--git-dir"], cwd=self.temp_dir, max_output=0))
+        self.assertEqual(len(ctx.exception.stderr), 16)
+        self.assertTrue(ctx.exception.stderr.endswith("\n"))
+
+    def test_remote_check_is_cached(self):
+        """Test that a remote probe result is reused within the TTL"""
+        import bot
+        bot._remote_status_cache.clear()
+        status = asyncio.run(bot.check_remote_connection(self.temp_dir))
+        self.assertEqual(status, 'connection_error')
+        with patch('bot.run_git') as mock_run:
+            self.assertEqual(asyncio.run(bot.check_remote_connection(self.temp_dir)), 'connection_error')
+        mock_run.assert_not_called()
+        bot._remote_status_cache.clear()
+
+    def test_remote_check_reprobes_after_changes(self):
+        """Test that a config change or forget_remote_status invalidates the cached status"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        self.assertEqual(asyncio.run(bot.check_remote_connection(repo)), 'connection_error')
+
+        subprocess.run(["git", "remote", "add", "origin", str(repo)], cwd=repo, check=True)
+        self.assertEqual(asyncio.run(bot.check_remote_connection(repo)), 'connected')
+
+        bot._remote_status_cache[str(repo)] = (bot.time.monotonic(), bot._git_config_mtime(repo), 'timeout')
+        bot.forget_remote_status(repo)
+        self.assertEqual(asyncio.run(bot.check_remote_connection(repo)), 'connected')
+        bot._remote_status_cache.clear()
+        shutil.rmtree(repo)
+
+class TestReadBlob(unittest.TestCase):
+    """Test reading files from git through the cat-file batch process"""
+
+    def test_read_blob_follows_new_commits(self):
+        """Test contents, missing files and reuse of one process across commits"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        (repo / "a.md").write_text("one")
+        subprocess.run(git + ["add", "a.md"], cwd=repo, check=True)
+        subprocess.run(git + ["commit", "-qm", "1"], cwd=repo, check=True)
+
+        async def scenario():
+            first = await bot.read_blob(repo, "HEAD", "a.md")
+            missing = await bot.read_blob(repo, "HEAD", "b.md")
+            proc = bot._cat_file_procs[str(repo)]
+            (repo / "a.md").write_text("two")
+            subprocess.run(git + ["commit", "-qam", "2"], cwd=repo, check=True)
+            second = await bot.read_blob(repo, "HEAD", "a.md")
+            self.assertIs(bot._cat_file_procs[str(repo)], proc)
+            bot.close_blob_reader(repo)
+            await proc.wait()
+            return first, missing, second
+
+        self.assertEqual(asyncio.run(scenario()), (b"one", None, b"two"))
+        shutil.rmtree(repo)
+
+    def test_cancelled_read_drops_the_process(self):
+        """Test that a read cancelled mid-reply can't hand its blob to the next read"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        (repo / "a.md").write_text("aaa")
+        (repo / "b.md").write_text("bbb")
+        subprocess.run(git + ["add", "."], cwd=repo, check=True)
+        subprocess.run(git + ["commit", "-qm", "1"], cwd=repo, check=True)
+
+        async def scenario():
+            await bot.read_blob(repo, "HEAD", "b.md")
+            cancelled = bot._cat_file_procs[str(repo)]
+            with patch('bot._read_cat_file_reply', side_effect=asyncio.CancelledError):
+                with self.assertRaises(asyncio.CancelledError):
+                    await bot.read_blob(repo, "HEAD", "a.md")
+            self.assertNotIn(str(repo), bot._cat_file_procs)
+            await cancelled.wait()
+            result = await bot.read_blob(repo, "HEAD", "b.md")
+            proc = bot._cat_file_procs[str(repo)]
+            bot.close_blob_reader(repo)
+            await proc.wait()
+            return result
+
+        self.assertEqual(asyncio.run(scenario()), b"bbb")
+        shutil.rmtree(repo)
+
+    def test_waiter_behind_a_failed_read_keeps_the_lock(self):
+        """Test that a read queued behind a failing one gets its file and the lock is not replaced"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        (repo / "b.md").write_text("bbb")
+        subprocess.run(git + ["add", "."], cwd=repo, check=True)
+        subprocess.run(git + ["commit", "-qm", "1"], cwd=repo, check=True)
+        real_reply = bot._read_cat_file_reply
+        failed = []
+
+        async def reply(proc):
+            if not failed:
+                failed.append(True)
+                raise OSError("broken pipe")
+            return await real_reply(proc)
+
+        async def scenario():
+            lock = bot._cat_file_locks.setdefault(str(repo), asyncio.Lock())
+            with patch('bot._read_cat_file_reply', side_effect=reply):
+                failing, waiter = await asyncio.gather(bot.read_blob(repo, "HEAD", "a.md"),
+                                                       bot.read_blob(repo, "HEAD", "b.md"),
+                                                       return_exceptions=True)
+            # A new lock would let a later caller share the process with the waiter
+            self.assertIs(bot._cat_file_locks.get(str(repo)), lock)
+            proc = bot._cat_file_procs[str(repo)]
+            bot.close_blob_reader(repo)
+            await proc.wait()
+            return failing, waiter
+
+        failing, waiter = asyncio.run(scenario())
+        self.assertIsInstance(failing, OSError)
+        self.assertEqual(waiter, b"bbb")
+        bot._cat_file_locks.pop(str(repo), None)
+        shutil.rmtree(repo)
+
+class TestPorcelainV2Status(unittest.TestCase):
+    """Test parsing of git status --porcelain=v2 --branch output"""
+
+    def test_branch_headers_and_changes(self):
+        """Test upstream, ahead/behind and change detection"""
+        out = (
+            "# branch.oid 1234567890abcdef\n"
+            "# branch.head main\n"
+            "# branch.upstream origin/main\n"
+            "# branch.ab +2 -5\n"
+            "1 .M N... 100644 100644 100644 abc abc docs/report.docx\n"
+        )
+        status = parse_porcelain_v2_status(out)
+        self.assertEqual(status['upstream'], 'origin/main')
+        self.assertEqual(status['ahead'], 2)
+        self.assertEqual(status['behind'], 5)
+        self.assertTrue(status['has_changes'])
+
+    def test_clean_tree_without_upstream(self):
+        """Test a clean branch with no upstream configured"""
+        status = parse_porcelain_v2_status("# branch.oid abc\n# branch.head main\n")
+        self.assertIsNone(status['upstream'])
+        self.assertEqual((status['ahead'], status['behind']), (0, 0))
+        self.assertFalse(status['has_changes'])
+
+class TestUserReposCache(unittest.TestCase):
+    """Test the user repos cache and its git username index"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.user_repos_file = Path(self.temp_dir) / "user_repos.json"
+
+        import bot
+        bot.USER_REPOS_FILE = self.user_repos_file
+        bot.user_repos_cache = None
+
+    def tearDown(self):
+        import bot
+        bot.user_repos_cache = None
+        if self.user_repos_file.exists():
+            self.user_repos_file.unlink()
+        os.rmdir(self.temp_dir)
+
+    def test_git_username_index(self):
+        """Test that loading and saving rebuild the git -> Telegram index"""
+        import bot
+        self.user_repos_file.write_text(json.dumps({
+            "1:alice": {"telegram_id": 1, "git_username": "alice", "telegram_username": "alice_tg"},
+            "2": {"telegram_id": 2, "git_username": None}
+        }))
+
+        repos = bot.load_user_repos()
+        self.assertEqual(bot._git_username_to_telegram, {"alice": "alice_tg"})
+
+        repos["3:bob"] = {"telegram_id": 3, "git_username": "bob", "telegram_username": "bob_tg"}
+        bot.save_user_repos(repos)
+        self.assertEqual(bot._git_username_to_telegram.get("bob"), "bob_tg")
+        self.assertIs(bot.load_user_repos(), repos)
+
+    def test_unchanged_file_not_reparsed_after_ttl(self):
+        """Test that an expired cache is kept while the file's mtime is unchanged"""
+        import bot
+        self.user_repos_file.write_text(json.dumps({"1": {"telegram_id": 1}}))
+        repos = bot.load_user_repos()
+
+        bot._user_repos_loaded_at = 0.0
+        self.assertIs(bot.load_user_repos(), repos)
+
+        self.user_repos_file.write_text(json.dumps({"2": {"telegram_id": 2}}))
+        os.utime(self.user_repos_file, ns=(0, bot._user_repos_mtime + 1))
+        bot._user_repos_loaded_at = 0.0
+        self.assertEqual(list(bot.load_user_repos()), ["2"])
+
+    def test_unchanged_save_not_rewritten(self):
+        """Test that saving identical content leaves the file alone"""
+        import bot
+        repos = {"1": {"telegram_id": 1}}
+        bot.save_user_repos(repos)
+        inode = self.user_repos_file.stat().st_ino
+        bot.save_user_repos(repos)
+        self.assertEqual(self.user_repos_file.stat().st_ino, inode)
+        repos["2"] = {"telegram_id": 2}
+        bot.save_user_repos(repos)
+        self.assertNotEqual(self.user_repos_file.stat().st_ino, inode)
+
+    def test_older_snapshot_does_not_replace_newer(self):
+        """Test that overlapping writes leave the newest snapshot on disk"""
+        import bot
+        bot._set_user_repos_cache({"1": {"telegram_id": 1}})
+        bot._user_repos_dirty = True
+        older = bot._take_pending_user_repos()
+        bot.user_repos_cache["2"] = {"telegram_id": 2}
+        bot._user_repos_dirty = True
+        newer = bot._take_pending_user_repos()
+
+        threads = [threading.Thread(target=bot._write_user_repos_file, args=newer)
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        bot._write_user_repos_file(*older)
+
+        self.assertEqual(json.loads(self.user_repos_file.read_text()),
+                         {"1": {"telegram_id": 1}, "2": {"telegram_id": 2}})
+        self.assertFalse(self.user_repos_file.with_name("user_repos.json.tmp").exists())
+
+    def test_get_user_repo_memo_invalidated_on_save(self):
+        """Test that get_user_repo lookups are reused until the repos are saved"""
+        import bot
+        self.user_repos_file.write_text(json.dumps({
+            "1:alice": {"telegram_id": 1, "git_username": "alice", "repo_path": "/a"}
+        }))
+
+        self.assertEqual(bot.get_user_repo(1)['repo_path'], "/a")
+        self.assertIsNone(bot.get_user_repo(2))
+        self.assertIn(("2", None), bot._user_repo_lookups)
+
+        bot.set_user_repo(2, "/b", username="bob")
+        self.assertEqual(bot.get_user_repo(2)['repo_path'], "/b")
+
+    def test_telegram_id_index(self):
+        """Test that find_user_key uses the index and falls back for foreign dicts"""
+        import bot
+        self.user_repos_file.write_text(json.dumps({
+            "1:alice": {"telegram_id": 1, "git_username": "alice"},
+            "1:alice2": {"telegram_id": 1, "git_username": "alice2"}
+        }))
+
+        repos = bot.load_user_repos()
+        self.assertEqual(bot.find_user_key(repos, "1"), "1:alice")
+        self.assertIsNone(bot.find_user_key(repos, 2))
+        self.assertEqual(bot.find_user_key({"x": {"telegram_id": 2}}, 2), "x")
+
+    def test_saves_inside_event_loop_are_coalesced(self):
+        """Test that saves made while the bot runs reach the file once, after a delay"""
+        import bot
+
+        async def edit_twice():
+            bot.save_user_repos({"1": {"telegram_id": 1}})
+            bot.save_user_repos({"1": {"telegram_id": 1}, "2": {"telegram_id": 2}})
+            self.assertFalse(self.user_repos_file.exists())
+            self.assertEqual(len(bot.load_user_repos()), 2)
+            await asyncio.sleep(bot.USER_REPOS_FLUSH_DELAY * 2)
+
+        asyncio.run(edit_twice())
+        self.assertEqual(set(json.loads(self.user_repos_file.read_text())), {"1", "2"})
+        self.assertFalse(bot._user_repos_dirty)
+
+class TestKeyboardCache(unittest.TestCase):
+    """Test that static reply keyboards are built once per flag combination"""
+
+    def test_document_keyboard_shared_across_documents(self):
+        """Test that the document menu ignores the document name when caching"""
+        import bot
+        first = bot.get_document_keyboard("a.docx", is_locked=True, can_unlock=True)
+        second = bot.get_document_keyboard("b.docx", is_locked=True, can_unlock=True)
+        self.assertIs(first, second)
+        self.assertIsNot(first, bot.get_document_keyboard("a.docx", is_locked=False))
+
+    def test_locks_keyboard_keyed_by_admin_flag(self):
+        """Test that the locks menu differs only by the admin flag"""
+        import bot
+        with patch.object(bot, 'ADMIN_IDS', {"1"}):
+            self.assertIs(bot.get_locks_keyboard(2), bot.get_locks_keyboard(3))
+            self.assertIsNot(bot.get_locks_keyboard(1), bot.get_locks_keyboard(2))
+
+    def test_main_keyboard_keyed_by_admin_flag(self):
+        """Test that all non-admin users share one main menu"""
+        import bot
+        with patch.object(bot, 'ADMIN_IDS', {"1"}):
+            self.assertIs(bot.get_main_keyboard(2), bot.get_main_keyboard(None))
+            self.assertIsNot(bot.get_main_keyboard(1), bot.get_main_keyboard(2))
+
+    def test_users_keyboard_keyed_by_user_ids(self):
+        """Test that the users menu is rebuilt only when the user list changes"""
+        import bot
+        self.assertIs(bot._build_users_keyboard(("1", "2")), bot._build_users_keyboard(("1", "2")))
+        self.assertIsNot(bot._build_users_keyboard(("1",)), bot._build_users_keyboard(("1", "2")))
+
+class TestAdminOnly(unittest.TestCase):
+    """Test the admin_only handler decorator"""
+
+    def test_rejects_non_admins(self):
+        """Test that only admins reach the wrapped handler"""
+        import bot
+        calls = []
+
+        @bot.admin_only("denied")
+        async def handler(message, doc_name):
+            calls.append(doc_name)
+            return doc_name
+
+        with patch.object(bot, 'ADMIN_IDS', frozenset({"1"})):
+            admin = Mock(from_user=Mock(id=1), answer=AsyncMock())
+            user = Mock(from_user=Mock(id=2), answer=AsyncMock())
+            self.assertEqual(asyncio.run(handler(admin, "a.docx")), "a.docx")
+            self.assertIsNone(asyncio.run(handler(user, "b.docx")))
+
+        self.assertEqual(calls, ["a.docx"])
+        self.assertEqual(user.answer.await_args.args[0], "denied")
+        admin.answer.assert_not_awaited()
+
+class TestTextHandlers(unittest.TestCase):
+    """Test the text_router dispatch table"""
+
+    def test_git_operations_buttons_are_routed(self):
+        """Test that every Git operations button except navigation has a handler"""
+        import bot
+        with patch.object(bot, 'PTB_AVAILABLE', False):
+            keyboard = bot._build_git_operations_keyboard.__wrapped__(True)
+        labels = [label for row in keyboard for label in row if label != "◀️ Назад в главное меню"]
+        for label in labels:
+            self.assertIn(label, bot.TEXT_HANDLERS)
+
+    def test_document_buttons_are_routed(self):
+        """Test that every document menu button has a handler"""
+        import bot
+        with patch.object(bot, 'PTB_AVAILABLE', False):
+            keyboard = bot._build_document_keyboard.__wrapped__(False, False, False)
+        for label in (label for row in keyboard for label in row if label != "🧾 Статус документа"):
+            self.assertIn(label, bot.TEXT_HANDLERS)
+
+class TestDiscardDirectory(unittest.TestCase):
+    """Test moving old working trees aside for background deletion"""
+
+    def test_path_is_free_immediately_and_trash_is_removed(self):
+        """Test that the directory is renamed away and later deleted"""
+        import bot
+        parent = Path(tempfile.mkdtemp())
+        repo = parent / "repo"
+        (repo / "docs").mkdir(parents=True)
+        (repo / "docs" / "a.docx").write_bytes(b"x")
+
+        async def discard():
+            await bot.discard_directory(repo)
+            self.assertFalse(repo.exists())
+            await asyncio.gather(*bot._background_tasks)
+
+        asyncio.run(discard())
+        self.assertEqual(list(parent.iterdir()), [])
+        os.rmdir(parent)
+
+class TestUserLock(unittest.TestCase):
+    """Test per-user serialization of updates"""
+
+    def test_same_user_serialized_other_users_not(self):
+        """Test that one user's updates queue while other users proceed"""
+        import bot
+        order = []
+
+        async def update(user_id, name, delay):
+            async with bot.user_lock(user_id):
+                order.append(f"{name}+")
+                await asyncio.sleep(delay)
+                order.append(f"{name}-")
+
+        async def run():
+            await asyncio.gather(update(1, "a", 0.05), update(1, "b", 0), update(2, "c", 0))
+
+        asyncio.run(run())
+        self.assertLess(order.index("a-"), order.index("b+"))
+        self.assertLess(order.index("c-"), order.index("a-"))
+        self.assertEqual(bot._user_locks, {})
+
+class TestWaitForUserInput(unittest.TestCase):
+    """Test handing the next message of a user to a waiting flow"""
+
+    def test_flow_receives_next_message(self):
+        """Test that the pending future gets the text and is then removed"""
+        import bot
+
+        async def run():
+            waiter = asyncio.create_task(bot.wait_for_user_input(42, timeout=1))
+            await asyncio.sleep(0)
+            bot.user_edit_sessions[42]['pending_input'].set_result("alice")
+            return await waiter
+
+        try:
+            self.assertEqual(asyncio.run(run()), "alice")
+            self.assertNotIn('pending_input', bot.user_edit_sessions[42])
+        finally:
+            bot.user_edit_sessions.pop(42, None)
+
+    def test_times_out(self):
+        """Test that an unanswered flow gives up"""
+        import bot
+        try:
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(bot.wait_for_user_input(43, timeout=0.01))
+        finally:
+            bot.user_edit_sessions.pop(43, None)
+
+class TestWriteRepoGitConfig(unittest.TestCase):
+    """Test writing repository git config without spawning git"""
+
+    def test_values_are_readable_by_git(self):
+        """Test that new, existing and quoted values are stored the way git config reads them"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        subprocess.run(["git", "config", "user.name", "old"], cwd=repo, check=True)
+
+        bot.write_repo_git_config(repo, {
+            'user.name': 'Иван "ivan"',
+            'user.email': 'ivan@example.com',
+            'credential.helper': 'store --file=/app/data/.git-credentials-1',
+        })
+
+        def get(name):
+            return subprocess.run(["git", "config", "--get", name], cwd=repo, check=True,
+                                  capture_output=True, text=True).stdout.rstrip("\n")
+
+        self.assertEqual(get("user.name"), 'Иван "ivan"')
+        self.assertEqual(get("user.email"), "ivan@example.com")
+        self.assertEqual(get("credential.helper"), "store --file=/app/data/.git-credentials-1")
+        self.assertFalse((repo / ".git" / "config.lock").exists())
+        shutil.rmtree(repo)
+
+    def test_newlines_and_control_characters(self):
+        """Test that newlines and tabs are escaped and other control characters rejected"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+
+        bot.write_repo_git_config(repo, {'user.name': 'alice\nbob', 'user.email': 'a\tb@example.com'})
+        with self.assertRaises(ValueError):
+            bot.write_repo_git_config(repo, {'user.name': 'alice\rbob'})
+
+        def get(name):
+            return subprocess.run(["git", "config", "--get", name], cwd=repo, check=True,
+                                  capture_output=True, text=True).stdout.rstrip("\n")
+
+        self.assertEqual(get("user.name"), "alice\nbob")
+        self.assertEqual(get("user.email"), "a\tb@example.com")
+        subprocess.run(["git", "status"], cwd=repo, check=True, capture_output=True)
+        shutil.rmtree(repo)
+
+    def test_credentials_setup_spawns_no_git(self):
+        """Test that credential setup edits .git/config in place and git config --list still parses it"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        subprocess.run(["git", "remote", "add", "origin", "https://github.com/u/r.git"], cwd=repo, check=True)
+
+        with patch('bot.write_private_file'), patch('bot.subprocess.run') as mock_run:
+            bot.configure_git_with_credentials(str(repo), "ivan", "secret", user_id=7)
+        mock_run.assert_not_called()
+
+        listed = subprocess.run(["git", "config", "--list", "--local"], cwd=repo, check=True,
+                                capture_output=True, text=True).stdout.splitlines()
+        self.assertIn("user.name=ivan", listed)
+        self.assertIn("credential.helper=store --file=/app/data/.git-credentials-7", listed)
+        self.assertIn("remote.origin.url=https://github.com/u/r.git", listed)
+        shutil.rmtree(repo)
+
+    def test_origin_url_read_from_config(self):
+        """Test that the origin URL is read from .git/config and follows set-url"""
+        import bot
+        import shutil
+        import subprocess
+        repo = Path(tempfile.mkdtemp())
+        subprocess.run(["git", "init", "-q", str(repo)], check=True)
+        self.assertEqual(bot._read_origin_url(repo), "")
+        subprocess.run(["git", "remote", "add", "origin", "git@gitlab.com:g/p.git"], cwd=repo, check=True)
+        self.assertEqual(bot._read_origin_url(repo), "git@gitlab.com:g/p.git")
+        subprocess.run(["git", "remote", "set-url", "origin", "https://gitlab.example.com/g/p.git"], cwd=repo, check=True)
+        self.assertEqual(bot._read_origin_url(repo), "https://gitlab.example.com/g/p.git")
+        shutil.rmtree(repo)
+
+class TestRateLimit(unittest.TestCase):
+    """Test per-user token bucket rate limiting"""
+
+    def test_burst_then_refill(self):
+        """Test that a burst is allowed, the next action is refused and tokens refill over time"""
+        import bot
+        from unittest import mock
+        user_id = 424242
+        bot._rate_buckets.pop(user_id, None)
+        with mock.patch.object(bot.time, "monotonic", return_value=1000.0) as clock:
+            results = [bot.check_rate_limit(user_id) for _ in range(bot.ACTION_BURST + 1)]
+            self.assertEqual(results, [True] * bot.ACTION_BURST + [False])
+            clock.return_value += bot.ACTION_RATE_LIMIT
+            self.assertTrue(bot.check_rate_limit(user_id))
+            self.assertFalse(bot.check_rate_limit(user_id))
+        bot._rate_buckets.pop(user_id, None)
+
+class TestSSHKeyCache(unittest.TestCase):
+    """Test in-memory caching of users' SSH keys"""
+
+    def test_keys_read_once_and_forgotten_on_delete(self):
+        """Test that keys are served from memory until they are deleted"""
+        import bot
+        import shutil
+        manager = bot.SSHKeyManager.__new__(bot.SSHKeyManager)
+        manager.ssh_dir = Path(tempfile.mkdtemp())
+        user_id = 515151
+        bot._ssh_key_cache.pop(user_id, None)
+        self.assertEqual(manager.get_user_ssh_key(user_id), {})
+
+        key_dir = manager.ssh_dir / str(user_id)
+        key_dir.mkdir()
+        (key_dir / "id_ed25519").write_text("private\n")
+        (key_dir / "id_ed25519.pub").write_text("ssh-ed25519 AAAA\n")
+        self.assertEqual(manager.get_user_ssh_key(user_id)['public_key'], "ssh-ed25519 AAAA")
+
+        (key_dir / "id_ed25519.pub").write_text("changed\n")
+        self.assertEqual(manager.get_user_ssh_key(user_id)['public_key'], "ssh-ed25519 AAAA")
+
+        self.assertTrue(manager.delete_user_ssh_keys(user_id))
+        self.assertEqual(manager.get_user_ssh_key(user_id), {})
+        shutil.rmtree(manager.ssh_dir)
+
 def run_tests():
     """Run all tests and return results"""
     loader = unittest.TestLoader()